@@ -1,23 +1,43 @@
 import datetime
+import concurrent.futures
+import functools
+import logging
+import operator
 import os
 import mundi
 import pandas as pd
 from subprocess import run
 from pydemic.diseases import disease
 from pathlib import Path
+import matplotlib
+matplotlib.use('Agg')
 from matplotlib import pyplot as plt
+from utils import (
+    init_worker_logging,
+    pool_context,
+    queue_logging,
+    triang_mean,
+    up_to_date,
+)
 # from mundi.plugins.epidemic import covid19
 
+log = logging.getLogger(__name__)
 covid19 = disease("covid-19")
 PATH = Path(__file__).parent / "data"
 
+# Every plot is drawn on the same figure and cleared after saving
+FIG, AX = plt.subplots()
+
 
 def plot_region(path: Path, region: mundi.Region, ext='png'):
     """
     Plot state.
     """
-    df = pd.read_csv(path / 'epicurve.csv').iloc[1:]
-    plot_data(path, df, region, ext)
+    src = path / 'epicurve.parquet'
+    df = pd.read_parquet(src).drop(index=0)
+    outputs = [path / f'{name}.{ext}' for name in ('obitos', 'casos', 'criticos')]
+    if not all(up_to_date(out, src) for out in outputs):
+        plot_data(path, df, region, ext)
     df.index.name = 'day'
     return df
 
@@ -28,55 +48,69 @@ def plot_data(path, data: pd.DataFrame, region, ext='png', future=60, past=120):
     today = datetime.datetime.now().date()
     
     def common(name):
-        plt.legend()
-        plt.tight_layout()
-        _y0, y1 = plt.ylim()
-        plt.plot([0, 0], [0, y1], 'k--', lw=2)
-        plt.ylim(0, y1)
-        plt.xlim(data.index[0], data.index[-1])
-        plt.grid(True)
-        # plt.show() 
-        plt.savefig(path / name)
-        plt.clf()
+        AX.legend()
+        FIG.tight_layout()
+        _y0, y1 = AX.get_ylim()
+        AX.plot([0, 0], [0, y1], 'k--', lw=2)
+        AX.set_ylim(0, y1)
+        AX.set_xlim(data.index[0], data.index[-1])
+        AX.grid(True)
+        FIG.savefig(path / name)
+        AX.cla()
 
     deaths = data['new_deaths']
-    deaths.rolling(14, 1, center=True, win_type='triang').mean().plot(label='média móvel')
-    deaths.plot(label='mortes/dia')
-    plt.xlabel(f'dias (a partir de {today})')
-    plt.ylabel('mortes')
-    plt.title(f'Projeção de óbitos por Covid-19 ({region.name})')
+    pd.Series(triang_mean(deaths.to_numpy()), index=deaths.index).plot(ax=AX, label='média móvel')
+    deaths.plot(ax=AX, label='mortes/dia')
+    AX.set_xlabel(f'dias (a partir de {today})')
+    AX.set_ylabel('mortes')
+    AX.set_title(f'Projeção de óbitos por Covid-19 ({region.name})')
     common(f'obitos.{ext}')
 
     cases = data['new_cases']
-    cases.rolling(14, 1, center=True, win_type='triang').mean().plot(label='média móvel')
-    cases.plot(label='casos/dia')
-    plt.xlabel(f'dias (a partir de {today})')
-    plt.ylabel('casos')
-    plt.title(f'Projeção de casos por Covid-19 ({region.name})')
+    pd.Series(triang_mean(cases.to_numpy()), index=cases.index).plot(ax=AX, label='média móvel')
+    cases.plot(ax=AX, label='casos/dia')
+    AX.set_xlabel(f'dias (a partir de {today})')
+    AX.set_ylabel('casos')
+    AX.set_title(f'Projeção de casos por Covid-19 ({region.name})')
     common(f'casos.{ext}')
 
     icu = data['C']
-    icu.rolling(14, 1, center=True, win_type='triang').mean().plot(label='média móvel')
-    icu.plot(label='leitos UTI')
-    plt.xlabel(f'dias (a partir de {today})')
-    plt.ylabel('leitos ocupados')
-    plt.title(f'Projeção de pressão hospitalar por Covid-19 ({region.name})')
+    pd.Series(triang_mean(icu.to_numpy()), index=icu.index).plot(ax=AX, label='média móvel')
+    icu.plot(ax=AX, label='leitos UTI')
+    AX.set_xlabel(f'dias (a partir de {today})')
+    AX.set_ylabel('leitos ocupados')
+    AX.set_title(f'Projeção de pressão hospitalar por Covid-19 ({region.name})')
     common(f'criticos.{ext}')
 
 
+def _plot_one(region: mundi.Region) -> pd.DataFrame:
+    log.info("processing %s", region)
+    return plot_region(PATH / region.id, region)
+
+
 def plot_all(path: Path = PATH):
     """
     Prepare all states data
     """
     states = mundi.regions(type="state", country="BR")
-    data = []
-    for r in sorted(states):
-        print(f"\nprocessing {r}")
-        data.append(plot_region(PATH / r.id, r).reset_index())
+    context = pool_context()
+    queue = context.Queue()
+    executor = concurrent.futures.ProcessPoolExecutor(
+        mp_context=context, initializer=init_worker_logging, initargs=(queue,)
+    )
+
+    # Forked workers start on the first submit; do it before the log
+    # listener thread exists
+    results = executor.map(_plot_one, sorted(states))
+    with queue_logging(queue), executor:
+        data = list(results)
     
     br = path / "BR"
     br.mkdir(exist_ok=True)
-    df = pd.concat(data).groupby('day').sum()
+    days = pd.RangeIndex(1, max(len(df) for df in data) + 1, name='day')
+    df = functools.reduce(
+        operator.add, (df.reindex(days, fill_value=0) for df in data)
+    )
     plot_data(br, df, mundi.region('BR'))
     df.to_csv(br / 'epicurve.csv')
 
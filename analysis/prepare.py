@@ -1,15 +1,30 @@
 import os
+import functools
+import logging
+import threading
 import mundi
+import numpy as np
 import pandas as pd
-from subprocess import run
+import tomli_w
+from subprocess import CalledProcessError, Popen
 from pydemic.diseases import disease
+from pydemic.utils.dataframe import force_monotonic, trim_zeros
 from pathlib import Path
 from matplotlib import pyplot as plt
-from typing import cast
 from warnings import warn
 import concurrent.futures
+from utils import (
+    WINDOW_SIZE,
+    diff_int,
+    init_worker_logging,
+    pool_context,
+    queue_logging,
+    triang_mean,
+    up_to_date,
+)
 # from mundi.plugins.epidemic import covid19
 
+log = logging.getLogger(__name__)
 caso_full_url = "https://data.brasil.io/dataset/covid19/caso_full.csv.gz"
 covid19 = disease("covid-19")
 PATH = Path(__file__).parent / "data"
@@ -17,107 +32,234 @@ CASES = os.path.expanduser("~/caso_full.csv.gz")
 RELEASE = 'release'
 EXECUTABLE = Path(__file__).parent.parent / 'target' / RELEASE / 'covid'
 EXECUTABLE = Path(__file__).parent / 'covid'
-WINDOW_SIZE = 14
-TOML_TEMPLATE = """
-prob_infection = 0.10
-n_contacts = 3.5
-num_iter = {num_iter}
-verbose = false
-pop_counts = {pop_counts}
-
-# Info
-delay = {delay}
-attack_rate = {attack}
-
-[epicurve]
-data = {epicurve_data}
-smoothness = {smoothness}
-"""
+THREADS_PER_SIM = 1
+
+# Pairs of 5-year age groups, with 80+ collected in the last bin
+AGE_BINS = np.arange(0, 17, 2)
+CASES_COLUMNS = {
+    "date": "str",
+    "state": "str",
+    "city_ibge_code": "float64",
+    "place_type": "category",
+    "last_available_confirmed": "float64",
+    "last_available_deaths": "float64",
+}
+CONF_DEFAULTS = {
+    "prob_infection": 0.10,
+    "n_contacts": 3.5,
+    "verbose": False,
+}
+
+@functools.lru_cache(1)
+def _load_caso_full() -> pd.DataFrame:
+    """
+    Load cumulative cases and deaths for every state from caso_full.csv.gz.
+
+    The file is decompressed and parsed only once per process. States are
+    aggregated from city rows exactly like pydemic's brasil_io_cases():
+    missing city entries count as -1 and dates with a negative sum are
+    dropped.
+    """
+    df = pd.read_csv(
+        CASES,
+        usecols=list(CASES_COLUMNS),
+        dtype=CASES_COLUMNS,
+        parse_dates=["date"],
+        compression="gzip",
+        engine="c",
+    )
+    df = df[(df["place_type"] == "city") & df["city_ibge_code"].notna()]
+    df = df.rename(
+        columns={"last_available_confirmed": "cases", "last_available_deaths": "deaths"}
+    )
+    df = df[["date", "state", "city_ibge_code", "cases", "deaths"]].dropna()
+
+    result = []
+    for col in ["cases", "deaths"]:
+        data = (
+            df.pivot_table(index=["state", "city_ibge_code"], columns="date", values=col)
+            .fillna(-1)
+            .groupby(level="state")
+            .sum()
+            .reset_index()
+            .melt(id_vars=["state"], var_name="date", value_name=col)
+        )
+        result.append(data[data[col] >= 0])
+    return (
+        pd.merge(*result, on=["state", "date"], how="outer")
+        .fillna(0)
+        .astype({"cases": int, "deaths": int})
+    )
+
+
+def epidemic_curve_from_df(df: pd.DataFrame, region: mundi.Region) -> pd.DataFrame:
+    """
+    Cumulative cases and deaths for region, indexed by date.
+
+    Same cleanup as covid19.epidemic_curve(region): leading empty days are
+    trimmed and downward corrections are removed with force_monotonic.
+    """
+    code = region.id.rpartition("-")[2]
+    curve = df[df["state"] == code].drop(columns="state").drop_duplicates("date")
+    curve = curve.set_index("date").sort_index()[["cases", "deaths"]]
+    return force_monotonic(trim_zeros(curve, "left"))
+
+
+def check_epidemic_curve(region: mundi.Region):
+    """
+    Raise an AssertionError if the curve built from the cached dataframe
+    differs from the one pydemic loads for region.
+    """
+    expected = covid19.epidemic_curve(region, path=CASES)
+    curve = epidemic_curve_from_df(_load_caso_full(), region)
+    pd.testing.assert_frame_equal(curve, expected, check_dtype=False, check_names=False)
+
 
 def prepare_region(path: Path, region: mundi.Region):
     """
     Create files to initialize a state.
     """
 
+    log.info("processing %s", region)
+
     # Age distribution 
     df = region.age_distribution
-    distrib = df.values.copy()[:18:2]
-    distrib += df.values[1:18:2]
-    distrib[-1] += df.values[18:].sum()
+    distrib = np.add.reduceat(df.values, AGE_BINS)
     
     # Estimate cases from deaths
-    curve = covid19.epidemic_curve(region, path=CASES)
-    deaths = cast(pd.Series,
-        curve["deaths"]
-        .rolling(WINDOW_SIZE, center=True, win_type="triang")
-        .mean()
-        .fillna(method="bfill")
-        .dropna()
-    )
+    curve = epidemic_curve_from_df(_load_caso_full(), region)
+    deaths = triang_mean(curve["deaths"].to_numpy(), min_periods=WINDOW_SIZE)
+    valid = np.flatnonzero(~np.isnan(deaths))
+    if not len(valid):
+        raise ValueError(f'{region.id}: death curve is shorter than {WINDOW_SIZE} days')
+    
+    # Back-fill the head and drop the incomplete windows at the tail
+    deaths = deaths[:valid[-1] + 1]
+    deaths[:valid[0]] = deaths[valid[0]]
     params = covid19.params(region=region)
     cases = (deaths / params.IFR).astype("int")
-    epicurve = cases.diff().fillna(0).astype("int").values
-    attack = 100 * cases.iloc[-1] / region.population
-    print("Attack rate: {:n}%".format(attack))
+    epicurve = diff_int(cases)
+    attack = 100 * cases[-1] / region.population
+    log.info("%s attack rate: %s%%", region.id, format(attack, "n"))
     
     # Clean epicurve
-    i, j = 0, len(epicurve) - 1
-    while epicurve[i] == 0:
-        i += 1
-    
-    while epicurve[j] == 0:
-        j -= 1
+    nz = np.flatnonzero(epicurve)
+    if not len(nz):
+        raise ValueError(f'{region.id}: epicurve has no new cases')
+    i, j = nz[0], nz[-1]
     
     if (n := len(epicurve) - j -1):
         m = n + WINDOW_SIZE // 2
-        epicurve = list(epicurve)[:j - WINDOW_SIZE // 2]
-        print(f'WARNING: {region.id} tail with {n} null items. trucanting epicurve to a {m} delay')
+        epicurve = epicurve[:j - WINDOW_SIZE // 2]
+        log.warning('%s tail with %d null items. trucanting epicurve to a %d delay', region.id, n, m)
         n += WINDOW_SIZE // 2
     epicurve = epicurve[i:j]
     
     # Create config
-    conf = TOML_TEMPLATE.format(
-        num_iter=60,
-        pop_counts=list(distrib),
-        epicurve_data=list(epicurve),
-        smoothness=0.75,
-        delay=n,
-        attack=attack,
-    )    
+    conf = tomli_w.dumps({
+        **CONF_DEFAULTS,
+        "num_iter": 60,
+        "pop_counts": distrib.tolist(),
+
+        # Info
+        "delay": int(n),
+        "attack_rate": float(attack),
+
+        "epicurve": {
+            "data": epicurve.tolist(),
+            "smoothness": 0.75,
+        },
+    })
     
-    with open(path / 'conf.toml', 'w') as fd:
-        fd.write(conf)
+    # Leave an unchanged config untouched so its mtime keeps the simulation
+    # from running again
+    conf_path = path / 'conf.toml'
+    if conf_path.exists() and conf_path.read_text() == conf:
+        log.info('%s: conf.toml is up to date', region.id)
+        return
+    conf_path.write_text(conf)
 
 
-def prepare_all(path: Path = PATH):
+def prepare_all(path: Path = PATH, check: bool = False):
     """
     Prepare all states data
     """
-    paths = []
-    states = mundi.regions(type="state", country="BR")
-    for state in sorted(states):
-        print(f"\nprocessing {state}")
-        data = path / state.id
+    states = sorted(mundi.regions(type="state", country="BR"))
+    if check:
+        check_epidemic_curve(states[0])
+    paths = [path / state.id for state in states]
+    for data in paths:
         data.mkdir(parents=True, exist_ok=True)
-        prepare_region(data, state)
-        paths.append(data)
+    
+    # Forked workers start on the first submit, after the cache is warm and
+    # before the log listener thread starts, so they share the parsed
+    # dataframe. Otherwise each worker loads it once on its first region.
+    context = pool_context()
+    if context.get_start_method() == "fork":
+        _load_caso_full()
+    queue = context.Queue()
+    executor = concurrent.futures.ProcessPoolExecutor(
+        mp_context=context, initializer=init_worker_logging, initargs=(queue,)
+    )
+    futures = [
+        executor.submit(prepare_region, data, state)
+        for data, state in zip(paths, states)
+    ]
 
-    with concurrent.futures.ThreadPoolExecutor() as executor:
+    with queue_logging(queue):
+        with executor:
+            for future in futures:
+                future.result()
+
+        run_simulations(paths)
+
+
+def run_simulations(paths, jobs=None):
+    """
+    Run the simulator on each path, with at most jobs processes at once.
+
+    Finished simulations are post-processed in worker threads while the
+    next ones run.
+    """
+    if jobs is None:
+        jobs = max(1, (os.cpu_count() or 1) // THREADS_PER_SIM)
+    slots = threading.BoundedSemaphore(jobs)
+
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
         futures = []
         for path in paths:
-            futures.append(executor.submit(run_simulation, path=path))
+            if up_to_date(path / 'epicurve.parquet', path / 'conf.toml', EXECUTABLE):
+                log.info('skipping %s: epicurve.parquet is up to date', path)
+                continue
+            slots.acquire()
+            log.info('running %s', path)
+            # The simulator echoes the whole epicurve to stdout
+            with open(path / 'simulation.log', 'wb') as out:
+                proc = Popen(EXECUTABLE, cwd=path, stdout=out)
+            futures.append(executor.submit(_finish_simulation, proc, path, slots))
+        
+        for future in futures:
+            future.result()
+
+
+def _finish_simulation(proc: Popen, path: Path, slots: threading.BoundedSemaphore):
+    try:
+        proc.wait()
+    finally:
+        slots.release()
+    if proc.returncode:
+        raise CalledProcessError(proc.returncode, EXECUTABLE)
+    process_simulation(path)
 
 
-def run_simulation(path):
-    print(f'running {path}')
-    run(EXECUTABLE, cwd=path)
-    res: pd.DataFrame = pd.read_csv(path / 'epicurve.csv')
-    res['new_cases'] = -res['S'].diff().fillna(0).astype('int')
-    res['new_deaths'] = res['D'].diff().fillna(0).astype('int')
+def process_simulation(path):
+    res: pd.DataFrame = pd.read_csv(path / 'epicurve.csv', dtype='int64', engine='c')
+    res['new_cases'] = -diff_int(res['S'].to_numpy())
+    res['new_deaths'] = diff_int(res['D'].to_numpy())
     res['cases'] = res['S'].iloc[0] - res['S']
     res['deaths'] = res['D'] - res['D'].iloc[0]
-    res.to_csv(path / 'epicurve.csv')
-    print(f'analysis finished: {path}')
+    res.to_parquet(path / 'epicurve.parquet', index=False)
+    log.info('analysis finished: %s', path)
     
 
 if __name__ == "__main__":
@@ -0,0 +1,105 @@
+import contextlib
+import logging
+import multiprocessing
+import sys
+import numpy as np
+from logging.handlers import QueueHandler, QueueListener
+from pathlib import Path
+from scipy.signal.windows import triang
+
+WINDOW_SIZE = 14
+TRIANG_WEIGHTS = triang(WINDOW_SIZE)
+
+
+def triang_mean(x, window: int = WINDOW_SIZE, min_periods: int = 1) -> np.ndarray:
+    """
+    Centered triangular moving average.
+
+    Same as ``pd.Series(x).rolling(window, min_periods, center=True,
+    win_type='triang').mean()``, computed with a single convolution.
+    """
+    x = np.asarray(x, dtype=float)
+    weights = TRIANG_WEIGHTS if window == WINDOW_SIZE else triang(window)
+    offset = (window - 1) // 2
+    valid = ~np.isnan(x)
+
+    # Windows that hang over the edges are normalized by the weights of
+    # the observations they actually cover
+    total = np.convolve(np.where(valid, x, 0.0), weights)[offset:offset + len(x)]
+    norm = np.convolve(valid.astype(float), weights)[offset:offset + len(x)]
+    count = np.convolve(valid.astype(float), np.ones(window))[offset:offset + len(x)]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        out = total / norm
+    out[count < min_periods] = np.nan
+    return out
+
+
+def diff_int(a) -> np.ndarray:
+    """
+    First differences of an integer array, with 0 as the first element.
+
+    Same as ``pd.Series(a).diff().fillna(0).astype(int)``, without the
+    round-trip through float.
+    """
+    a = np.asarray(a)
+    out = np.empty(len(a), dtype=np.int64)
+    out[:1] = 0
+    np.subtract(a[1:], a[:-1], out=out[1:])
+    return out
+
+
+def up_to_date(target: Path, *sources: Path) -> bool:
+    """
+    True if target exists and is newer than all sources.
+    """
+    if not target.exists():
+        return False
+    mtime = target.stat().st_mtime
+    return all(src.stat().st_mtime <= mtime for src in sources)
+
+
+def pool_context():
+    """
+    Multiprocessing context for worker pools.
+
+    Fork lets workers share what the parent has already loaded. It is not
+    available on Windows and not safe on macOS, which use the default
+    context instead.
+    """
+    if "fork" in multiprocessing.get_all_start_methods() and sys.platform != "darwin":
+        return multiprocessing.get_context("fork")
+    return multiprocessing.get_context()
+
+
+def init_worker_logging(queue):
+    """
+    Send log records from the current process to queue.
+    """
+    root = logging.getLogger()
+    root.handlers[:] = [QueueHandler(queue)]
+    root.setLevel(logging.INFO)
+
+
+@contextlib.contextmanager
+def queue_logging(queue):
+    """
+    Write log records from this process, and from workers that send them
+    to queue with init_worker_logging, to stderr.
+
+    Records from this process go straight to the stream; worker records
+    are written by a listener thread. The root logger is restored on exit.
+    """
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(levelname)s: %(message)s"))
+    root = logging.getLogger()
+    handlers, level = root.handlers[:], root.level
+    root.handlers[:] = [handler]
+    root.setLevel(logging.INFO)
+    listener = QueueListener(queue, handler)
+    listener.start()
+    try:
+        yield
+    finally:
+        listener.stop()
+        root.handlers[:] = handlers
+        root.setLevel(level)